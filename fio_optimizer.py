@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
 import subprocess
+import functools
+import hashlib
+import shelve
+import shutil
 import json
 import logging
 import sys
 import os
-from typing import Union, Tuple, List
+import re
+import tempfile
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson is optional; it parses large multi-client reports several times faster.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ==============================================================================
 # FIO CONFIGURATION - !!! PLEASE EDIT THESE VALUES !!!
@@ -29,14 +43,79 @@ FIO_CLIENT_FILE = "client.txt"
 # The threshold for what is considered a 'significant' IOPS improvement (5%).
 IOPS_IMPROVEMENT_THRESHOLD = 1.05
 
+# Latency SLO in milliseconds. A test whose 99% CLAT exceeds this is not
+# accepted as a result, and higher iodepths for that numjobs are skipped since
+# they only add latency. Leave as float("inf") to disable.
+MAX_CLAT_MS = float("inf")
+
+# Local runs only: if the host's CPUs were busier than this fraction during a
+# numjobs sweep and IOPS barely moved, the kernel is the bottleneck and higher
+# numjobs values are not tested.
+CPU_SATURATION_THRESHOLD = 0.90
+
+# How much a numjobs sweep must beat the previous one on saturated CPUs to keep
+# going (1.02 = 2% more IOPS). Smaller gains count as "IOPS barely moved".
+CPU_SATURATION_IOPS_MARGIN = 1.02
+
+# Local runs only: pin this script to one CPU and start fio on the remaining
+# CPUs through taskset, so the driver never competes with fio for CPU time.
+ISOLATE_DRIVER_CPU = True
+
 # The executable name or path for fio.
 FIO_EXECUTABLE = "fio"
 
 # Iterations and not abosolute values
 MIN_NUMJOBS_RUNS = 4
 MIN_IODEPTH_RUNS = 4
+
+# Number of iodepth points dispatched concurrently for the same numjobs value.
+# Concurrent runs must not share a device, so raising this requires one entry
+# in FIO_PARALLEL_TARGETS per concurrent run. Each run gets its own target
+# through the 'filename' variable, i.e. the job file must use
+# 'filename=${filename}'. Use identical devices so results stay comparable.
+MAX_PARALLEL_RUNS = 1
+FIO_PARALLEL_TARGETS = []
+
+# Successful results are memoized on disk, keyed by the job file contents, the
+# client list, the fio executable, FIO_PARALLEL_TARGETS, the CPU isolation
+# setting and the (numjobs, iodepth) point, so reruns skip unchanged tests.
+# Set USE_RESULT_CACHE = False for validation runs that must hit the hardware.
+USE_RESULT_CACHE = True
+RESULT_CACHE_FILE = os.path.expanduser("~/.cache/fio_optimizer/results")
+
+# Search strategy: "grid" doubles iodepth and numjobs until IOPS plateau.
+# "bayes" samples the same powers-of-2 grid with optuna's TPE sampler and stops
+# after BAYES_TRIALS tests (requires 'pip install optuna').
+SEARCH_STRATEGY = "grid"
+BAYES_TRIALS = 25
+
+# I/O engine override applied to every section of the job file.
+#    - "auto": local runs on Linux >= 5.6 use io_uring with registered buffers
+#      and registered files; otherwise the job file is used as is.
+#    - "io_uring": force io_uring, adding SQPOLL where permitted. SQPOLL threads
+#      busy-poll, so the CPU-saturation check is skipped with it.
+#    - "libaio": force libaio.
+#    - "": always use the job file's own engine.
+FIO_IOENGINE = "auto"
 # ==============================================================================
 
+log = logging.getLogger(__name__)
+
+# Keys read from each fio job block.
+_RW_KEYS = ("read", "write")
+_CLAT = "clat_ns"
+_P99_KEY = "99.000000"
+
+# In client mode fio writes the server probe line ("hostname=..., be=0, ...")
+# and "<host>"-prefixed server text to the same stream as the JSON report.
+_REPORT_START = re.compile(rb"^\{", re.MULTILINE)
+
+# Environment for fio child processes, copied once at startup.
+_BASE_ENV = os.environ.copy()
+
+# CPUs this process may use, captured before the driver pins itself.
+_ALLOWED_CPUS = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+
 
 def setup_logging():
     """Configures logging to print informative messages to the console."""
@@ -47,7 +126,7 @@ def setup_logging():
         stream=sys.stdout,
     )
 
-def read_clients_from_file(filepath: str) -> List[str]:
+def read_clients_from_file(filepath: str) -> list[str]:
     """
     Reads a list of clients from a file, one client per line.
     
@@ -60,189 +139,439 @@ def read_clients_from_file(filepath: str) -> List[str]:
     if not filepath:
         return []
     try:
-        with open(filepath, 'r') as f:
-            # Read each line, strip whitespace, and ignore empty lines or comments
-            clients = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+        with open(filepath, 'r', encoding="utf-8", errors="replace") as f:
+            # Read each line, strip whitespace once, and ignore empty lines or comments
+            clients = [s for line in f if (s := line.strip()) and s[0] != '#']
         return clients
     except FileNotFoundError:
-        logging.warning(f"Client file '{filepath}' not found. Will run in local mode.")
+        log.warning("Client file '%s' not found. Will run in local mode.", filepath)
         return []
 
-def parse_fio_json(json_output: str) -> Tuple[Union[float, None], Union[float, None]]:
+def read_cpu_times(cpus: list[int] | None = None) -> tuple[int, int] | None:
+    """
+    Returns cumulative (busy, idle) CPU ticks from /proc/stat, or None if unavailable.
+    Sums the given CPUs' lines, or uses the aggregate line if cpus is None.
+    """
+    wanted = {"cpu"} if cpus is None else {f"cpu{cpu}" for cpu in cpus}
+    busy = idle = 0
+    try:
+        with open("/proc/stat", 'r') as f:
+            for line in f:
+                name, *values = line.split()
+                if not name.startswith("cpu"):
+                    break
+                if name in wanted:
+                    # user nice system idle iowait irq softirq steal
+                    fields = [int(v) for v in values[:8]]
+                    idle += fields[3] + fields[4]
+                    busy += sum(fields) - fields[3] - fields[4]
+    except (OSError, ValueError):
+        return None
+    return busy, idle
+
+def cpu_busy_fraction(before: tuple[int, int] | None, after: tuple[int, int] | None) -> float:
+    """Returns the fraction of CPU time spent busy between two read_cpu_times() samples."""
+    if before is None or after is None:
+        return 0.0
+    busy, idle = after[0] - before[0], after[1] - before[1]
+    return busy / (busy + idle) if busy + idle > 0 else 0.0
+
+def isolate_cpus(use_clients: bool) -> bool:
+    """Returns True if the driver and fio should run on separate CPUs."""
+    return (ISOLATE_DRIVER_CPU and not use_clients and len(_ALLOWED_CPUS) > 1
+            and shutil.which("taskset") is not None)
+
+def kernel_version() -> tuple[int, int]:
+    """Returns the (major, minor) version of the running Linux kernel, or (0, 0)."""
+    match = re.match(r"(\d+)\.(\d+)", os.uname().release)
+    return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+
+def select_ioengine(clients: list[str]) -> str | None:
+    """
+    Resolves FIO_IOENGINE to the engine to force, or None to keep the job file's engine.
+    """
+    if FIO_IOENGINE != "auto":
+        return FIO_IOENGINE or None
+    # The local kernel says nothing about the clients' kernels
+    if clients or not sys.platform.startswith("linux"):
+        return None
+    return "io_uring" if kernel_version() >= (5, 6) else None
+
+def job_file_max_bs(job_file: str) -> int | None:
+    """
+    Returns the largest block size in a job file in bytes, fio's 4k default if none
+    is set, or None if a block size cannot be read (e.g. it uses a variable).
+    """
+    sizes = []
+    with open(job_file, 'r') as f:
+        for line in f:
+            key, sep, value = line.partition("=")
+            if not sep or key.strip() not in ("bs", "blocksize", "bsrange", "blocksize_range", "bssplit"):
+                continue
+            if "$" in value:
+                return None
+            for number, unit in re.findall(r"(\d+)\s*([kmgt]?)", value.lower()):
+                sizes.append(int(number) * 1024 ** " kmgt".index(unit or " "))
+    return max(sizes) if sizes else 4096
+
+def fixedbufs_fit(job_file: str) -> bool:
+    """
+    Returns True if registered buffers for the deepest queue tested fit in RLIMIT_MEMLOCK.
+    """
+    if os.geteuid() == 0:
+        return True
+    import resource
+    max_bs = job_file_max_bs(job_file)
+    if max_bs is None:
+        return False
+    limit = resource.getrlimit(resource.RLIMIT_MEMLOCK)[0]
+    # 256 is the deepest iodepth either search strategy tests
+    return limit == resource.RLIM_INFINITY or limit >= 256 * max_bs
+
+def engine_overrides(engine: str, job_file: str, clients: list[str]) -> list[str]:
+    """Returns the job file options that force the given ioengine."""
+    overrides = [f"ioengine={engine}"]
+    if engine == "io_uring":
+        overrides.append("registerfiles=1")
+        # The local uid, memlock limit and kernel say nothing about the
+        # clients, so buffer registration and SQPOLL are local-only.
+        if clients:
+            return overrides
+        # fixedbufs pins iodepth x bs per job against RLIMIT_MEMLOCK
+        if fixedbufs_fit(job_file):
+            overrides.append("fixedbufs=1")
+        # SQPOLL only on explicit request, since it disables the CPU saturation
+        # check. Unprivileged SQPOLL needs Linux >= 5.11.
+        if FIO_IOENGINE == "io_uring" and (os.geteuid() == 0 or kernel_version() >= (5, 11)):
+            overrides.append("sqthread_poll=1")
+    return overrides
+
+def job_file_uses_filename_var(job_file: str) -> bool:
+    """Returns True if the job file takes its target from the ${filename} variable."""
+    with open(job_file, 'r') as f:
+        for line in f:
+            key, sep, value = line.partition("=")
+            if sep and key.strip() == "filename" and "${filename}" in value:
+                return True
+    return False
+
+def job_file_ioengine(job_file: str) -> str:
+    """Returns the last ioengine set in a job file, or fio's default if none is."""
+    engine = "fio default"
+    with open(job_file, 'r') as f:
+        for line in f:
+            key, sep, value = line.partition("=")
+            if sep and key.strip() == "ioengine":
+                engine = value.strip()
+    return engine
+
+def write_engine_job_file(job_file: str, overrides: list[str]) -> str:
+    """
+    Writes a copy of the job file with the engine options appended to every section.
+    fio does not let command-line options override job file settings, and the
+    last value in a section wins, so the override lines go at the end of each one.
+
+    Returns:
+        The path of the generated job file. The caller is responsible for removing it.
+    """
+    lines = []
+    in_section = False
+    with open(job_file, 'r') as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.strip().startswith("[") and in_section:
+                lines.extend(overrides)
+            in_section = in_section or line.strip().startswith("[")
+            lines.append(line)
+    if in_section:
+        lines.extend(overrides)
+
+    # Keep the copy next to the original so relative includes still resolve
+    job_dir = os.path.dirname(os.path.abspath(job_file))
+    with tempfile.NamedTemporaryFile('w', dir=job_dir, prefix=".fio_optimizer_", suffix=".job",
+                                     delete=False) as tmp:
+        tmp.write("\n".join(lines) + "\n")
+    return tmp.name
+
+def load_fio_report(report: bytes) -> dict:
+    """
+    Decodes a fio JSON report, skipping any non-JSON text around it.
+    """
+    match = _REPORT_START.search(report)
+    if match and match.start():
+        report = report[match.start():]
+    try:
+        return orjson.loads(report) if orjson else json.loads(report)
+    except json.JSONDecodeError:
+        # Server text after the report; decode only the leading JSON object
+        return json.JSONDecoder().raw_decode(report.decode("utf-8", errors="replace"))[0]
+
+def parse_fio_json(json_output: bytes) -> tuple[float | None, float | None]:
     """
     Parses FIO JSON, intelligently handling both single-node and aggregated multi-client output.
     """
     try:
-        data = json.loads(json_output)
-        target_job = None
+        data = load_fio_report(json_output)
         latency_metric_used = "99th percentile CLAT"
 
+        # Client runs report under "client_stats", local runs under "jobs".
+        jobs = data.get("client_stats") or data.get("jobs") or []
+
         # Priority 1: Find the aggregated "All clients" block for multi-client runs.
-        if "client_stats" in data:
-            for job in data["client_stats"]:
-                if job.get("jobname") == "All clients":
-                    target_job = job
-                    #logging.info("Found aggregated 'All clients' block for parsing.")
-                    break
-        
-        if not target_job:
-            target_job = data["client_stats"][0]
-            #logging.info("Parsing first job in 'jobs' array (local run).")
+        # Otherwise fall back to the first job (local run or single client).
+        target_job = next((job for job in jobs if job.get("jobname") == "All clients"), None) \
+            or (jobs[0] if jobs else None)
 
         if not target_job:
-            logging.error("Could not find a suitable job block to parse in FIO output.")
+            log.error("Could not find a suitable job block to parse in FIO output.")
             return None, None
 
-        # Determine if it's a read or write job and extract metrics.
-        if "read" in target_job and target_job["read"]["iops"] > 0:
-            iops = target_job["read"]["iops"]
-            clat_ns_data = target_job["read"]["clat_ns"]
-        elif "write" in target_job and target_job["write"]["iops"] > 0:
-            iops = target_job["write"]["iops"]
-            clat_ns_data = target_job["write"]["clat_ns"]
-        else:
-            logging.error(f"Target job '{target_job.get('jobname')}' has no read/write stats.")
+        # Determine if it's a read or write job. fio reports both directions, with
+        # zero IOPS for the unused one, so pick the first with actual I/O.
+        rw = next((target_job[k] for k in _RW_KEYS if k in target_job and target_job[k]["iops"] > 0), None)
+        if rw is None:
+            log.error("Target job '%s' has no read/write stats.", target_job.get('jobname'))
             return None, None
+        iops = rw["iops"]
+        clat_ns_data = rw[_CLAT]
 
         # In aggregated "All clients" view, percentiles are not available. Use mean.
-        if "percentile" in clat_ns_data:
-            clat_ns = clat_ns_data["percentile"]["99.000000"]
-        else:
-            clat_ns = clat_ns_data["mean"]
-            #latency_metric_used = "mean CLAT (percentiles not available in aggregate view)"
+        percentiles = clat_ns_data.get("percentile")
+        clat_ns = percentiles[_P99_KEY] if percentiles else clat_ns_data["mean"]
 
         #logging.info(f"Using {latency_metric_used} for latency check.")
         return iops, clat_ns / 1_000_000  # convert ns to ms
 
     except (json.JSONDecodeError, KeyError, IndexError) as e:
-        logging.error(f"Error parsing fio JSON output: {e}")
-        logging.debug(f"Problematic JSON string: {json_output[:1000]}") # Log first 1k chars
+        log.error("Error parsing fio JSON output: %s", e)
+        log.debug("Problematic JSON string: %s", json_output[:1000]) # Log first 1k chars
         return None, None
 
-def run_fio(numjobs: int, iodepth: int, clients: List[str]) -> Tuple[Union[float, None], Union[float, None]]:
+class ResultCache:
+    """
+    Persistent memo of fio results keyed by job file, clients, fio executable,
+    targets, CPU isolation, numjobs and iodepth.
+    """
+
+    def __init__(self, path: str, job_file: str, clients: list[str]):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = shelve.open(path)
+        with open(job_file, 'rb') as f:
+            job_hash = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        # Everything besides the job file that changes what a run measures
+        fio_path = shutil.which(FIO_EXECUTABLE) or FIO_EXECUTABLE
+        fio_cpus = ",".join(str(cpu) for cpu in _ALLOWED_CPUS[1:]) if isolate_cpus(bool(clients)) else ""
+        setup = [*clients, f"fio={fio_path}", f"targets={','.join(FIO_PARALLEL_TARGETS)}", f"fio_cpus={fio_cpus}"]
+        setup_hash = hashlib.blake2b("\n".join(setup).encode(), digest_size=16).hexdigest()
+        self._prefix = f"{job_hash}:{setup_hash}"
+
+    def _key(self, numjobs: int, iodepth: int) -> str:
+        return f"{self._prefix}:{numjobs}:{iodepth}"
+
+    def get(self, numjobs: int, iodepth: int) -> tuple[float, float] | None:
+        return self._db.get(self._key(numjobs, iodepth))
+
+    def put(self, numjobs: int, iodepth: int, result: tuple[float, float]):
+        self._db[self._key(numjobs, iodepth)] = result
+        self._db.sync()
+
+    def close(self):
+        self._db.close()
+
+@functools.lru_cache(maxsize=None)
+def fio_base_command(job_file: str, use_clients: bool) -> tuple[str, ...]:
+    """
+    Returns the fio arguments shared by every run, built once per job file.
+    """
+    command = (FIO_EXECUTABLE, job_file, "--output-format=json")
+    # fio inherits the driver's affinity, so widen it to every CPU but the driver's
+    if isolate_cpus(use_clients):
+        fio_cpus = ",".join(str(cpu) for cpu in _ALLOWED_CPUS[1:])
+        command = ("taskset", "-c", fio_cpus) + command
+    # Add the client file argument in client/server mode
+    if use_clients:
+        command += (f"--client={FIO_CLIENT_FILE}",)
+    return command
+
+def run_fio(numjobs: int, iodepth: int, clients: list[str], job_file: str = FIO_JOB_FILE,
+            target: str | None = None) -> tuple[float | None, float | None]:
     """
     Constructs and executes a fio command using a job file and optional clients.
+    If target is given, it is exported as the job file's 'filename' variable.
     """
-    logging.info(f"Running test with numjobs={numjobs}, iodepth={iodepth}...")
-
-    nj = str(numjobs)
-    iod = str(iodepth)
-    os.environ['numjobs'] = nj
-    os.environ['iodepth'] = iod
-    command = [
-        FIO_EXECUTABLE,
-        FIO_JOB_FILE,
-        f"--output-format=json",
-        ]
-
-    # Add client arguments if the list is not empty
-    if clients:
-        #for client in clients:
-            #command.append(f"--client={client}")
-            command.append(f"--client={FIO_CLIENT_FILE}")
+    log.info("Running test with numjobs=%d, iodepth=%d...", numjobs, iodepth)
+
+    # Pass the job file variables per invocation instead of mutating os.environ,
+    # so concurrent runs cannot clobber each other's values.
+    env = _BASE_ENV | {'numjobs': str(numjobs), 'iodepth': str(iodepth)}
+    if target:
+        env['filename'] = target
+    # fio writes the report to its own file; in client mode that file can
+    # still carry server text, which parse_fio_json skips.
+    with tempfile.NamedTemporaryFile(prefix="fio_optimizer_", suffix=".json", delete=False) as tmp:
+        output_file = tmp.name
+    command = (*fio_base_command(job_file, bool(clients)), f"--output={output_file}")
 
     try:
         process = subprocess.run(
-            command, capture_output=True, text=True, check=True, encoding="utf-8"
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            text=True, check=True, encoding="utf-8", env=env
         )
-        stdout = process.stdout.strip()
-
-        # deregister the env variables
-
-        #print (process.stdout)
-        if not stdout:
-            logging.error("FIO command produced no output.")
-            logging.error(f"Command: {' '.join(command)}")
-            logging.error(f"FIO Error Message (stderr):\n{process.stderr}")
+        # json/orjson accept raw bytes, so skip a separate UTF-8 decode pass
+        with open(output_file, 'rb') as f:
+            report = f.read()
+
+        if not report.strip():
+            log.error("FIO command produced no output.")
+            log.error("Command: %s", ' '.join(command))
+            log.error("FIO Error Message (stderr):\n%s", process.stderr)
             return None, None
 
-        # Handle cases where fio outputs multiple JSON objects concatenated together.
-        # We find the last valid JSON object and parse that one.
-        if stdout.count('"jobname"') >= 1:
-            #logging.warning("Multiple JSON objects detected. Parsing the final aggregated output.")
-            last_json_start = stdout.rfind("version")
-            #print (last_json_start)
-            stdout = stdout[last_json_start:]
-            stdout = "{ \"" + stdout
-            #print (stdout)
-        
-        return parse_fio_json(stdout)
+        return parse_fio_json(report)
 
     except FileNotFoundError:
-        logging.error(f"FIO executable not found at '{FIO_EXECUTABLE}'. Please check your path.")
+        log.error("FIO executable not found at '%s'. Please check your path.", FIO_EXECUTABLE)
         sys.exit(1)
     except subprocess.CalledProcessError as e:
-        logging.error("FIO command failed with a non-zero exit code.")
-        logging.error(f"Command: {' '.join(command)}")
-        logging.error(f"Error Message. Stderr:\n{e.stderr}")
+        log.error("FIO command failed with a non-zero exit code.")
+        log.error("Command: %s", ' '.join(command))
+        log.error("Error Message. Stderr:\n%s", e.stderr)
         return None, None
+    finally:
+        os.remove(output_file)
 
+def run_batch(numjobs: int, iodepths: list[int], clients: list[str], cache: ResultCache | None = None,
+              job_file: str = FIO_JOB_FILE, max_workers: int | None = None) -> list[tuple[float | None, float | None]]:
+    """
+    Runs fio for each iodepth with the same numjobs, up to max_workers at a time
+    (MAX_PARALLEL_RUNS when not given).
+    Points already present in the result cache are not run again.
 
-def main():
-    """Main function to orchestrate the fio optimization process."""
-    setup_logging()
-    
-    if not os.path.exists(FIO_JOB_FILE):
-        logging.error(f"FIO job file not found at '{FIO_JOB_FILE}'. Please fix the path.")
-        sys.exit(1)
-    
-    # Read the list of clients from the specified file
-    clients = read_clients_from_file(FIO_CLIENT_FILE)
+    Returns:
+        A list of (iops, clat_ms) tuples in the same order as iodepths.
+    """
+    results = {}
+    if cache is not None:
+        for iodepth in iodepths:
+            cached = cache.get(numjobs, iodepth)
+            if cached is not None:
+                log.info("Using cached result for numjobs=%d, iodepth=%d.", numjobs, iodepth)
+                results[iodepth] = cached
+    pending = [iodepth for iodepth in iodepths if iodepth not in results]
+
+    if max_workers is None:
+        max_workers = MAX_PARALLEL_RUNS
+    workers = min(len(pending), max_workers)
+    if workers <= 1:
+        # A job file using ${filename} still needs a target when runs are serial
+        target = FIO_PARALLEL_TARGETS[0] if FIO_PARALLEL_TARGETS else None
+        fresh = [run_fio(numjobs, iodepth, clients, job_file, target) for iodepth in pending]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Each concurrent run gets its own target so runs never contend for a device
+            futures = [executor.submit(run_fio, numjobs, iodepth, clients, job_file, FIO_PARALLEL_TARGETS[i])
+                       for i, iodepth in enumerate(pending)]
+            fresh = [future.result() for future in futures]
 
-    logging.info("Starting FIO performance optimization script.")
-    logging.info(f"Using Job File: {FIO_JOB_FILE}")
+    for iodepth, result in zip(pending, fresh):
+        results[iodepth] = result
+        if cache is not None and result[0] is not None:
+            cache.put(numjobs, iodepth, result)
 
-    if clients:
-        logging.info(f"Client/Server mode enabled.")
-        #logging.info(f"Client/Server mode enabled. Using clients: {', '.join(clients)}")
-    else:
-        logging.info("No client file specified or found. Running in local mode.")
-    
+    return [results[iodepth] for iodepth in iodepths]
+
+def grid_search(clients: list[str], cache: ResultCache | None, job_file: str,
+                check_cpu: bool = True) -> tuple[int, int, float] | None:
+    """
+    Doubles iodepth for each numjobs value, then doubles numjobs, until IOPS plateau.
+    With check_cpu, local runs also stop scaling numjobs once the CPUs saturate.
+
+    Returns:
+        (optimal numjobs, optimal iodepth, max IOPS), or None if a fio run failed
+        or no configuration met the latency SLO.
+    """
     optimal_nj, optimal_id, best_overall_iops, last_nj_best_iops = 0, 0, 0.0, 0.0
 
+    # When the driver is pinned, only the CPUs fio runs on can saturate
+    fio_cpus = _ALLOWED_CPUS[1:] if isolate_cpus(bool(clients)) else None
+    sample_cpu = check_cpu and not clients
+
     nj_iops_history = deque(maxlen=3)
     nj_run_count = 0
     current_nj = 1
     while current_nj <= 128:
         nj_run_count += 1
-        logging.info("-" * 16 + f" OPTIMIZING FOR NUMJOBS = {current_nj} " + "-" * 16)
+        log.info("%s OPTIMIZING FOR NUMJOBS = %d %s", "-" * 16, current_nj, "-" * 16)
         best_iops_for_nj, best_id_for_nj = 0.0, 0
-        id_results_history = deque(maxlen=3)
+        id_iops_history = deque(maxlen=3)
         id_run_count = 0
+        max_cpu_busy = 0.0
 
         current_id = 1
-        while current_id <= 256:
-            id_run_count += 1
+        id_plateaued = False
+        while current_id <= 256 and not id_plateaued:
+            # Collect the next batch of iodepth candidates for this numjobs value
+            batch = []
+            while current_id <= 256 and len(batch) < MAX_PARALLEL_RUNS:
+                batch.append(current_id)
+                current_id *= 2
+
             # Pass the client list to the run_fio function
-            iops, clat_ms = run_fio(current_nj, current_id, clients)
-            if iops is None:
-                logging.error("Stopping optimization due to a FIO error.")
-                return
-
-            logging.info(f"--> Result: IOPS = {iops:.2f}, 99% CLAT = {clat_ms:.2f} ms")
-
-            #Consider omitting len(id_result_history) == 3
-            if id_run_count >= MIN_IODEPTH_RUNS and len(id_results_history) == 3:
-                max_iops_of_last_3 = max(r['iops'] for r in id_results_history)
-                if iops < max_iops_of_last_3 * IOPS_IMPROVEMENT_THRESHOLD:
-                    logging.info(f"IOPS plateaued for iodepth. Current IOPS {iops:.2f} is not a >5% improvement over the max of last 3 runs ({max_iops_of_last_3:.2f}).")
+            # Batches served entirely from the cache launch no fio, so their
+            # CPU sample would only measure the driver
+            launches_fio = cache is None or any(cache.get(current_nj, i) is None for i in batch)
+            cpu_before = read_cpu_times(fio_cpus) if sample_cpu and launches_fio else None
+            results = run_batch(current_nj, batch, clients, cache, job_file)
+            if cpu_before is not None:
+                max_cpu_busy = max(max_cpu_busy, cpu_busy_fraction(cpu_before, read_cpu_times(fio_cpus)))
+
+            for batch_id, (iops, clat_ms) in zip(batch, results):
+                id_run_count += 1
+                if iops is None:
+                    log.error("Stopping optimization due to a FIO error.")
+                    return None
+
+                log.info("--> Result (iodepth=%d): IOPS = %.2f, 99%% CLAT = %.2f ms", batch_id, iops, clat_ms)
+
+                if clat_ms > MAX_CLAT_MS:
+                    log.info("99%% CLAT %.2f ms exceeds the %.2f ms SLO. Skipping higher iodepths.", clat_ms, MAX_CLAT_MS)
+                    id_plateaued = True
                     break
-            # Store the current result
-            id_results_history.append({'iops': iops, 'clat': clat_ms})
-
-            # Track the best performance found so far for this numjobs value
-            if iops > best_iops_for_nj:
-                best_iops_for_nj = iops
-                best_id_for_nj = current_id
-                # And also track the best performance found overall
-                if best_iops_for_nj > best_overall_iops:
-                    best_overall_iops = best_iops_for_nj
-                    optimal_nj = current_nj
-                    optimal_id = best_id_for_nj
-            
-            current_id *= 2
-
-        logging.info(f"Considering CLAT, best result for numjobs={current_nj}: {best_iops_for_nj:.2f} IOPS at iodepth={best_id_for_nj}")
+
+                #Consider omitting len(id_result_history) == 3
+                if id_run_count >= MIN_IODEPTH_RUNS and len(id_iops_history) == 3:
+                    max_iops_of_last_3 = max(id_iops_history)
+                    if iops < max_iops_of_last_3 * IOPS_IMPROVEMENT_THRESHOLD:
+                        log.info("IOPS plateaued for iodepth. Current IOPS %.2f is not a >5%% improvement over the max of last 3 runs (%.2f).", iops, max_iops_of_last_3)
+                        id_plateaued = True
+                        break
+                # Store the current result
+                id_iops_history.append(iops)
+
+                # Track the best performance found so far for this numjobs value
+                if iops > best_iops_for_nj:
+                    best_iops_for_nj = iops
+                    best_id_for_nj = batch_id
+                    # And also track the best performance found overall
+                    if best_iops_for_nj > best_overall_iops:
+                        best_overall_iops = best_iops_for_nj
+                        optimal_nj = current_nj
+                        optimal_id = best_id_for_nj
+
+        log.info("Considering CLAT, best result for numjobs=%d: %.2f IOPS at iodepth=%d", current_nj, best_iops_for_nj, best_id_for_nj)
+
+        # More jobs only add queueing, so if no iodepth met the SLO here, none will
+        # at higher numjobs either. Stop before a 0 IOPS sweep enters the history.
+        if best_id_for_nj == 0:
+            log.info("No iodepth meets the %.2f ms 99%% CLAT SLO at numjobs=%d. Concluding optimization.",
+                     MAX_CLAT_MS, current_nj)
+            break
+
+        # Stop scaling numjobs once the host CPUs are saturated and IOPS stopped growing
+        if max_cpu_busy > CPU_SATURATION_THRESHOLD and nj_iops_history and best_iops_for_nj <= nj_iops_history[-1] * CPU_SATURATION_IOPS_MARGIN:
+            log.info("CPU-saturated: %.0f%% busy at numjobs=%d with no IOPS gain. Concluding optimization.",
+                     max_cpu_busy * 100, current_nj)
+            break
 
         # (NEW) Check for numjobs performance plateau after minimum runs
         if nj_run_count >= MIN_NUMJOBS_RUNS and len(nj_iops_history) == 3:
@@ -254,12 +583,132 @@ def main():
         nj_iops_history.append(best_iops_for_nj)
         current_nj *= 2
 
+    if optimal_nj == 0:
+        log.error("No configuration meets the %.2f ms 99%% CLAT SLO.", MAX_CLAT_MS)
+        return None
+
+    return optimal_nj, optimal_id, best_overall_iops
+
+
+def bayes_search(clients: list[str], cache: ResultCache | None, job_file: str) -> tuple[int, int, float] | None:
+    """
+    Samples the numjobs/iodepth grid with a TPE sampler for a fixed number of trials.
+
+    Returns:
+        (optimal numjobs, optimal iodepth, max IOPS), or None if a fio run failed
+        or no trial met the latency SLO.
+    """
+    try:
+        import optuna
+    except ImportError:
+        log.error("SEARCH_STRATEGY = 'bayes' requires optuna. Install it with 'pip install optuna'.")
+        sys.exit(1)
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+
+    fio_failed = False
+
+    def objective(trial):
+        nonlocal fio_failed
+        nj = trial.suggest_categorical("numjobs", [1, 2, 4, 8, 16, 32, 64, 128])
+        iod = trial.suggest_categorical("iodepth", [1, 2, 4, 8, 16, 32, 64, 128, 256])
+        iops, clat_ms = run_batch(nj, [iod], clients, cache, job_file)[0]
+        if iops is None:
+            fio_failed = True
+            trial.study.stop()
+            return 0.0
+        log.info("--> Result (numjobs=%d, iodepth=%d): IOPS = %.2f, 99%% CLAT = %.2f ms", nj, iod, iops, clat_ms)
+        trial.set_user_attr("clat_ms", clat_ms)
+        # Points that violate the latency SLO count as if they delivered nothing
+        return iops if clat_ms <= MAX_CLAT_MS else 0.0
+
+    study = optuna.create_study(direction="maximize", sampler=optuna.samplers.TPESampler())
+    study.optimize(objective, n_trials=BAYES_TRIALS)
+    if fio_failed:
+        log.error("Stopping optimization due to a FIO error.")
+        return None
+    if study.best_trial.user_attrs["clat_ms"] > MAX_CLAT_MS:
+        log.error("Every trial exceeded the %.2f ms 99%% CLAT SLO. No configuration qualifies.", MAX_CLAT_MS)
+        return None
+
+    return study.best_params["numjobs"], study.best_params["iodepth"], study.best_value
+
+
+def main():
+    """Main function to orchestrate the fio optimization process."""
+    setup_logging()
+    
+    if not os.path.exists(FIO_JOB_FILE):
+        log.error("FIO job file not found at '%s'. Please fix the path.", FIO_JOB_FILE)
+        sys.exit(1)
+    
+    if SEARCH_STRATEGY not in ("grid", "bayes"):
+        log.error("Unknown SEARCH_STRATEGY '%s'. Use 'grid' or 'bayes'.", SEARCH_STRATEGY)
+        sys.exit(1)
+
+    if MAX_PARALLEL_RUNS > 1 and len(FIO_PARALLEL_TARGETS) < MAX_PARALLEL_RUNS:
+        log.error("MAX_PARALLEL_RUNS = %d needs as many FIO_PARALLEL_TARGETS entries so concurrent runs do not share a device.", MAX_PARALLEL_RUNS)
+        sys.exit(1)
+
+    # Without ${filename} every concurrent run would hit the job file's own devices
+    if MAX_PARALLEL_RUNS > 1 and not job_file_uses_filename_var(FIO_JOB_FILE):
+        log.error("MAX_PARALLEL_RUNS = %d needs 'filename=${filename}' in '%s' so each run uses its own target.", MAX_PARALLEL_RUNS, FIO_JOB_FILE)
+        sys.exit(1)
+
+    # Read the list of clients from the specified file
+    clients = read_clients_from_file(FIO_CLIENT_FILE)
+
+    log.info("Starting FIO performance optimization script.")
+    log.info("Using Job File: %s", FIO_JOB_FILE)
+
+    if clients:
+        log.info("Client/Server mode enabled.")
+        #logging.info(f"Client/Server mode enabled. Using clients: {', '.join(clients)}")
+    else:
+        log.info("No client file specified or found. Running in local mode.")
+    
+    # Behind the taskset prefix a missing fio would only show up as a failed run
+    if shutil.which(FIO_EXECUTABLE) is None:
+        log.error("FIO executable not found at '%s'. Please check your path.", FIO_EXECUTABLE)
+        sys.exit(1)
+
+    if isolate_cpus(bool(clients)):
+        os.sched_setaffinity(0, {_ALLOWED_CPUS[0]})
+        log.info("Driver pinned to CPU %d; fio runs on the remaining CPUs.", _ALLOWED_CPUS[0])
+
+    job_file = FIO_JOB_FILE
+    engine = select_ioengine(clients)
+    overrides = engine_overrides(engine, FIO_JOB_FILE, clients) if engine else []
+    if overrides:
+        log.info("Overriding ioengine with %s.", ", ".join(overrides))
+        job_file = write_engine_job_file(FIO_JOB_FILE, overrides)
+    engine_used = ", ".join(overrides) + " (FIO_IOENGINE override)" if overrides \
+        else f"{job_file_ioengine(FIO_JOB_FILE)} (from job file)"
+    # SQPOLL threads busy-poll the submission queue, so CPU usage no longer
+    # says anything about saturation
+    check_cpu = "sqthread_poll=1" not in overrides
+
+    cache = ResultCache(RESULT_CACHE_FILE, job_file, clients) if USE_RESULT_CACHE else None
+    try:
+        if SEARCH_STRATEGY == "bayes":
+            result = bayes_search(clients, cache, job_file)
+        else:
+            result = grid_search(clients, cache, job_file, check_cpu)
+    finally:
+        if cache is not None:
+            cache.close()
+        if job_file != FIO_JOB_FILE:
+            os.remove(job_file)
+    if result is None:
+        return
+    optimal_nj, optimal_id, best_overall_iops = result
+
     print("\n" + "=" * 60)
     print("FIO OPTIMIZATION COMPLETE")
     print("=" * 60)
     print(f"Optimal numjobs: {optimal_nj}")
     print(f"Optimal iodepth: {optimal_id}")
     print(f"Max Achieved IOPS: {best_overall_iops:.2f}")
+    print(f"I/O engine: {engine_used}")
     print("=" * 60)
 
 